@@ -22,13 +22,22 @@ import os
 import re
 import json
 import time
+import queue
+import atexit
 import base64
+import asyncio
+import functools
+import itertools
+import threading
 import shutil
 import logging
 import tempfile
 import traceback
 from pathlib import Path
-from typing import List, Tuple, Optional
+from contextlib import ExitStack
+from html import unescape
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, List, Tuple, Optional
 from urllib.parse import urljoin, urlparse, unquote
 
 import requests
@@ -46,12 +55,38 @@ try:
     import patoolib
 except Exception:
     patoolib = None
+try:
+    import rarfile
+except Exception:
+    rarfile = None
+
+# fast JSON (optional; fallback to stdlib json)
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# HTML parsing (optional; fallback to regex)
+try:
+    import lxml.html as LH
+except Exception:
+    LH = None
+
+# CDP WebSocket (optional; fallback to performance logs)
+try:
+    import websockets
+except Exception:
+    websockets = None
 
 # -------------------------
 # CONFIG (请确认/修改)
 # -------------------------
 BISHENG_API_BASE_URL = "http://192.168.168.19:3001"
 KNOWLEDGE_BASE_ID = 254
+# 一次 multipart 请求上传多个文件；仅当毕昇接口确认接受多个 'file' 字段时开启
+BISHENG_BATCH_UPLOAD = False
+BISHENG_BATCH_MAX_FILES = 20
+BISHENG_BATCH_REJECT_STATUS = (400, 413, 422)  # 接口不接受批量 -> 回退逐个上传
 
 SERVER_BIND_IP = "0.0.0.0"
 SERVER_PORT = 5000
@@ -68,16 +103,33 @@ CHROMEDRIVER_PATH = os.environ.get("CHROMEDRIVER_PATH", "/usr/local/bin/chromedr
 CHROME_BINARY = os.environ.get("CHROME_BINARY", "/usr/bin/google-chrome-stable")
 
 HEADLESS = True
+# 只需 DOM + JS（opendown/GetValidateCode），装饰性资源一律不加载
+BLOCKED_URL_PATTERNS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+                        "*.woff*", "*.ttf", "*.otf", "*.css", "*/analytics*", "*/gtag*"]
 REQUESTS_VERIFY = False  # 内网证书容错，必要时改为 True
 
 # file ext that we consider attachments
 ATTACH_EXTS = ['.pdf', '.doc', '.docx', '.xls', '.xlsx', '.zip', '.rar', '.txt']
+# compiled once; longest ext first so '.docx' is not cut to '.doc'
+_ATTACH_SUFFIXES = tuple(ATTACH_EXTS)
+_ATTACH_EXT_ALT = '|'.join(re.escape(e) for e in sorted(ATTACH_EXTS, key=len, reverse=True))
+_ATTACH_RE = re.compile(r'(?:' + _ATTACH_EXT_ALT + r')(?:[?#]|$)', re.I)
+_ATTACH_URL_RE = re.compile(r'(https?://[^\s"\'<>]+(?:' + _ATTACH_EXT_ALT + r'))', re.I)
+_ATTACH_URL_RE_B = re.compile(_ATTACH_URL_RE.pattern.encode(), re.I)
+# "urlhref":"http..." at any depth, e.g. {"result":{"urlhref":...}}; escaped URLs fall through to the JSON walk
+_URLHREF_RE = re.compile(rb'"(?:urlhref|fileUrl|downloadUrl|url)"\s*:\s*"(https?://[^"\\]+)"', re.I)
+_HREF_RE = re.compile(r'href=[\'"]([^\'"]+)[\'"]', re.I)
 
 # timeouts
 IFRAME_WAIT_SEC = 6
 CLICK_NEW_WINDOW_WAIT = 8
 PERF_POLL_ITER = 6  # poll ×sleep(0.8) total ~5s
 PERF_POLL_SLEEP = 0.8
+CDP_WS_TIMEOUT = 10  # 直连 CDP WebSocket 的连接/单条命令超时
+DOWNLOAD_WORKERS = 8  # 附件并发下载线程数
+DRIVER_POOL_SIZE = 2  # 常驻浏览器数（同时处理的任务上限）
+UPLOAD_WORKERS = 4  # 上传毕昇并发线程数
+MAX_DOWNLOAD_BYTES = 500 * 1024 * 1024  # 单个附件大小上限
 
 # -------------------------
 # Logging
@@ -103,6 +155,7 @@ app = Flask(__name__)
 # -------------------------
 # Helper utilities
 # -------------------------
+@functools.lru_cache(maxsize=4096)
 def sanitize_filename(name: str) -> str:
     if not name:
         return ""
@@ -113,16 +166,26 @@ def sanitize_filename(name: str) -> str:
 def short_title(text: str) -> str:
     return sanitize_filename(text)[:15]
 
+@functools.lru_cache(maxsize=4096)
 def derive_filename_from_url(url: str) -> str:
     p = urlparse(url)
     name = unquote(Path(p.path).name or p.fragment or 'download')
     return sanitize_filename(name)
 
 def looks_like_attachment(s: Optional[str]) -> bool:
-    if not s:
-        return False
-    s = s.lower()
-    return any(s.endswith(ext) or (ext in s and s.endswith(tuple(ATTACH_EXTS))) for ext in ATTACH_EXTS)
+    return bool(s) and _ATTACH_RE.search(s) is not None
+
+def extract_hrefs_from_html(html: str) -> List[str]:
+    # link-bearing attributes only; unlike a regex scan this skips <script> bodies and comments
+    if not html:
+        return []
+    if LH is not None:
+        try:
+            tree = LH.fromstring(html)
+            return [str(v) for v in tree.xpath('//@href | //iframe/@src | //embed/@src | //object/@data')]
+        except Exception:
+            pass
+    return _HREF_RE.findall(html)
 
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
@@ -142,7 +205,9 @@ def build_driver(download_dir: Path, headless: bool = True):
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--disable-gpu")
     options.add_argument("--disable-popup-blocking")
-    options.add_argument(f"--user-data-dir={tempfile.mkdtemp(prefix='chrome_profile_')}")
+    # one profile per browser, kept for the driver's lifetime and removed by quit_driver
+    profile_dir = tempfile.mkdtemp(prefix='chrome_profile_')
+    options.add_argument(f"--user-data-dir={profile_dir}")
     options.add_argument("--window-size=1366,900")
     if CHROME_BINARY:
         options.binary_location = CHROME_BINARY
@@ -151,31 +216,308 @@ def build_driver(download_dir: Path, headless: bool = True):
         "download.default_directory": str(download_dir),
         "download.prompt_for_download": False,
         "download.directory_upgrade": True,
-        "plugins.always_open_pdf_externally": True  # PDF 使用外部下载
+        "plugins.always_open_pdf_externally": True,  # PDF 使用外部下载
+        # skip images / stylesheets / fonts / plugins; JavaScript stays on
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.managed_default_content_settings.fonts": 2,
+        "profile.managed_default_content_settings.plugins": 2,
     }
     options.add_experimental_option("prefs", prefs)
     # performance logs
     options.set_capability('goog:loggingPrefs', {'performance': 'ALL', 'browser': 'ALL'})
+    # network events only; page events are never read
+    options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
 
     # create driver
     try:
-        if CHROMEDRIVER_PATH:
-            driver = webdriver.Chrome(options=options, executable_path=CHROMEDRIVER_PATH)
-        else:
+        try:
+            if CHROMEDRIVER_PATH:
+                driver = webdriver.Chrome(options=options, executable_path=CHROMEDRIVER_PATH)
+            else:
+                driver = webdriver.Chrome(options=options)
+        except TypeError:
+            # some selenium versions use different signature
             driver = webdriver.Chrome(options=options)
-    except TypeError:
-        # some selenium versions use different signature
-        driver = webdriver.Chrome(options=options)
-    # enable Network domain for CDP response body retrieval
+    except Exception:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        raise
+    driver._profile_dir = profile_dir
+    # enable Network domain for CDP response body retrieval, and block asset URLs the prefs miss
     try:
         driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
     except Exception:
         # not fatal; we still try other fallbacks
         logger.info("CDP Network.enable not available in this environment.")
     driver.set_page_load_timeout(60)
     driver.set_script_timeout(60)
+    # CDP requestIds already inspected by extract_urls_from_perf_logs
+    driver._perf_seen = set()
+    # origins the current task visited; their storage is wiped by reset_driver
+    driver._task_origins = set()
+    # persistent CDP websocket: one multiplexed socket instead of per-body chromedriver round trips
+    driver.cdp_ws_url = find_page_ws_url(driver)
+    driver.cdp_listener = None
+    if websockets is not None and driver.cdp_ws_url:
+        try:
+            driver.cdp_listener = CdpListener(driver.cdp_ws_url)
+        except Exception as e:
+            logger.info(f"CDP WebSocket 连接失败，回退 performance logs: {e}")
     return driver
 
+def quit_driver(driver):
+    listener = getattr(driver, 'cdp_listener', None)
+    if listener is not None:
+        listener.close()
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    # Chrome has exited once quit() returns; its profile can go
+    profile_dir = getattr(driver, '_profile_dir', None)
+    if profile_dir:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+# -------------------------
+# Direct CDP WebSocket listener
+# -------------------------
+def find_page_ws_url(driver) -> Optional[str]:
+    # chromedriver 已为浏览器开启调试端口，地址在 capabilities 中；Network 事件需连到 page target
+    try:
+        addr = (driver.capabilities.get('goog:chromeOptions') or {}).get('debuggerAddress')
+        if not addr:
+            return None
+        targets = requests.get(f"http://{addr}/json/list", timeout=CDP_WS_TIMEOUT).json()
+        handle = driver.current_window_handle or ''
+    except Exception:
+        return None
+    pages = [t for t in targets if t.get('type') == 'page' and t.get('webSocketDebuggerUrl')]
+    for t in pages:
+        if t.get('id') and t['id'] in handle:
+            return t['webSocketDebuggerUrl']
+    return pages[0]['webSocketDebuggerUrl'] if pages else None
+
+class CdpListener:
+    """后台线程中常驻一个事件循环，经单条 WebSocket 订阅 Network 事件并并发拉取响应体。
+
+    响应在 Network.loadingFinished（或 loadingFailed）之后才交给调用方，此时响应体已可读取。
+    """
+
+    def __init__(self, ws_url: str):
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._loading = {}  # requestId -> responseReceived params, body not complete yet
+        self._ready = []  # responses whose loading finished (or failed)
+        self._lock = threading.Lock()
+        self._ready_cond = threading.Condition(self._lock)
+        self._closed = threading.Event()  # set once the read loop ends (tab closed/crashed, target detached)
+        self._ws = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="cdp-listener", daemon=True)
+        self._thread.start()
+        try:
+            self._run(self._connect(ws_url))
+        except Exception:
+            self.close()
+            raise
+
+    def _run(self, coro, timeout: float = CDP_WS_TIMEOUT * 2):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    async def _connect(self, ws_url: str):
+        self._ws = await websockets.connect(ws_url, max_size=None, open_timeout=CDP_WS_TIMEOUT)
+        self._loop.create_task(self._read_loop())
+        await self._send("Network.enable")
+
+    async def _read_loop(self):
+        try:
+            async for raw in self._ws:
+                msg = json.loads(raw)
+                if 'id' in msg:
+                    fut = self._pending.pop(msg['id'], None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(msg)
+                elif msg.get('method') == 'Network.responseReceived':
+                    params = msg.get('params', {})
+                    if is_asset_response(params):
+                        continue
+                    with self._lock:
+                        self._loading[params.get('requestId')] = params
+                elif msg.get('method') in ('Network.loadingFinished', 'Network.loadingFailed'):
+                    # failed loads still carry a usable URL/headers (e.g. aborted attachment navigations)
+                    with self._ready_cond:
+                        params = self._loading.pop(msg.get('params', {}).get('requestId'), None)
+                        if params is not None:
+                            self._ready.append(params)
+                            self._ready_cond.notify_all()
+        except Exception:
+            pass
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("CDP WebSocket closed"))
+            self._pending.clear()
+            # no more events will arrive; wake any waiter so it can fall back to performance logs
+            with self._ready_cond:
+                self._closed.set()
+                self._ready_cond.notify_all()
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed.is_set()
+
+    async def _send(self, method: str, params: Optional[dict] = None) -> dict:
+        msg_id = next(self._ids)
+        fut = self._loop.create_future()
+        self._pending[msg_id] = fut
+        await self._ws.send(json.dumps({'id': msg_id, 'method': method, 'params': params or {}}))
+        try:
+            msg = await asyncio.wait_for(fut, CDP_WS_TIMEOUT)
+        finally:
+            self._pending.pop(msg_id, None)
+        if 'error' in msg:
+            raise RuntimeError(msg['error'].get('message', 'CDP error'))
+        return msg.get('result', {})
+
+    def drain_responses(self) -> List[dict]:
+        with self._lock:
+            events, self._ready = self._ready, []
+        return events
+
+    def wait_for_responses(self, timeout: float) -> bool:
+        # wake as soon as any response body becomes retrievable
+        with self._ready_cond:
+            return bool(self._ready_cond.wait_for(lambda: self._ready or self._closed.is_set(), timeout))
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._ready = []
+
+    def get_response_bodies(self, request_ids: List[str]) -> List[Optional[dict]]:
+        async def fetch_all():
+            return await asyncio.gather(
+                *(self._send("Network.getResponseBody", {'requestId': rid}) for rid in request_ids),
+                return_exceptions=True)
+        if not request_ids:
+            return []
+        results = self._run(fetch_all())
+        return [r if isinstance(r, dict) else None for r in results]
+
+    def close(self):
+        try:
+            if self._ws is not None:
+                self._run(self._ws.close(), timeout=CDP_WS_TIMEOUT)
+        except Exception:
+            pass
+        self._closed.set()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+def live_cdp_listener(driver) -> Optional[CdpListener]:
+    # a listener whose socket has dropped no longer sees events; callers then read performance logs
+    listener = getattr(driver, 'cdp_listener', None)
+    if listener is not None and listener.alive:
+        return listener
+    return None
+
+# -------------------------
+# Driver pool: long-lived browsers reused across tasks
+# -------------------------
+_driver_pool = queue.Queue()
+_driver_slots = threading.BoundedSemaphore(DRIVER_POOL_SIZE)
+
+def warm_driver_pool():
+    for _ in range(DRIVER_POOL_SIZE - _driver_pool.qsize()):
+        try:
+            _driver_pool.put(build_driver(download_dir=TEMP_DOWNLOAD_DIR, headless=HEADLESS))
+        except Exception as e:
+            logger.warning(f"预热浏览器失败: {e}")
+            break
+
+def acquire_driver(download_dir: Path):
+    _driver_slots.acquire()
+    try:
+        try:
+            driver = _driver_pool.get_nowait()
+        except queue.Empty:
+            driver = build_driver(download_dir=download_dir, headless=HEADLESS)
+        # the download dir is fixed at launch; redirect it per task
+        try:
+            driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": str(download_dir)})
+        except Exception:
+            pass
+        return driver
+    except Exception:
+        _driver_slots.release()
+        raise
+
+def note_origin(driver, url: str):
+    p = urlparse(url or '')
+    if p.scheme in ('http', 'https') and p.netloc:
+        origins = getattr(driver, '_task_origins', None)
+        if origins is None:
+            origins = driver._task_origins = set()
+        origins.add(f"{p.scheme}://{p.netloc}")
+
+def reset_driver(driver) -> bool:
+    try:
+        # close popup windows left by the task, drop DOM and per-site state
+        handles = driver.window_handles
+        for h in handles[1:]:
+            driver.switch_to.window(h)
+            note_origin(driver, driver.current_url)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        note_origin(driver, driver.current_url)
+        # localStorage / IndexedDB / service workers etc. outlive the task in a pooled browser; a failure here
+        # propagates and the driver is discarded. sessionStorage is per tab and not covered by "all".
+        driver.execute_script("try { sessionStorage.clear(); } catch (e) {}")
+        for origin in getattr(driver, '_task_origins', ()):
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        driver._task_origins = set()
+        driver.get("about:blank")
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+        driver.delete_all_cookies()
+        # discard network events the next task must not see
+        driver._perf_seen = set()
+        listener = getattr(driver, 'cdp_listener', None)
+        if listener is not None and not listener.alive:
+            # the page target went away; this browser cannot be trusted for the next task
+            logger.warning("CDP WebSocket 已断开，丢弃浏览器")
+            return False
+        if listener is not None:
+            listener.clear()
+        # chromedriver buffers both logs until read; with a listener nothing else reads them, so drain
+        # them here or they grow for the pooled browser's whole lifetime
+        for log_type in ('performance', 'browser'):
+            try:
+                driver.get_log(log_type)
+            except Exception:
+                pass
+        return True
+    except Exception as e:
+        logger.warning(f"浏览器重置失败，丢弃: {e}")
+        return False
+
+def release_driver(driver, reusable: bool = True):
+    try:
+        if reusable and reset_driver(driver):
+            _driver_pool.put(driver)
+        else:
+            quit_driver(driver)
+    finally:
+        _driver_slots.release()
+
+@atexit.register
+def shutdown_driver_pool():
+    while True:
+        try:
+            quit_driver(_driver_pool.get_nowait())
+        except queue.Empty:
+            break
+
 # -------------------------
 # session from driver (cookies)
 # -------------------------
@@ -194,94 +536,149 @@ def session_from_driver(driver) -> requests.Session:
 # -------------------------
 # Performance logs parse + CDP response-body inspection
 # -------------------------
-def extract_urls_from_perf_logs(driver) -> List[str]:
-    urls = []
+_ASSET_RESOURCE_TYPES = {'Image', 'Stylesheet', 'Font', 'Media'}
+_ASSET_MIME_PREFIXES = ('image/', 'text/css', 'font/', 'audio/', 'video/')
+
+def is_asset_response(params: dict) -> bool:
+    # responses that can never carry an attachment link; no body fetch for these
+    if params.get('type') in _ASSET_RESOURCE_TYPES:
+        return True
+    mime = ((params.get('response') or {}).get('mimeType') or '').lower()
+    return mime.startswith(_ASSET_MIME_PREFIXES)
+
+def _response_body_bytes(body) -> bytes:
+    # keep bodies as bytes: JSON parsing and regex both run on bytes, no utf-8 decode pass
+    if not body:
+        return b""
+    if isinstance(body, dict):
+        # body may contain 'body' and 'base64Encoded'
+        b = body.get('body', '') or ''
+        if body.get('base64Encoded'):
+            try:
+                return base64.b64decode(b)
+            except Exception:
+                return b""
+        return b.encode('utf-8', errors='ignore')
+    return str(body).encode('utf-8', errors='ignore')
+
+def _json_loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _is_download_url(v: str) -> bool:
+    if v.endswith(_ATTACH_SUFFIXES):
+        return True
+    return v.startswith('http') and ('down.bidcenter' in v or any(ext in v for ext in ATTACH_EXTS))
+
+def _find_url_in_json(obj) -> Optional[str]:
+    # depth-first, same visiting order as a recursive walk; only dict string values are candidates
+    if not isinstance(obj, (dict, list)):
+        return None
+    stack = [obj]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, str):
+            if _is_download_url(cur):
+                return cur
+        elif isinstance(cur, dict):
+            stack.extend(reversed(list(cur.values())))
+        elif isinstance(cur, list):
+            stack.extend(v for v in reversed(cur) if isinstance(v, (dict, list)))
+    return None
+
+def _find_url_in_body(raw: bytes) -> Optional[str]:
+    # search for obvious patterns like "urlhref":"http..." or "result":{"urlhref":"..."}
+    # common case: one regex pass over the raw bytes, no deserialization
+    for m in _URLHREF_RE.finditer(raw):
+        v = m.group(1).decode('utf-8', errors='ignore')
+        if _is_download_url(v):
+            return v
+    # try JSON parse
     try:
-        logs = driver.get_log('performance')
+        j = _json_loads(raw)
     except Exception:
-        return urls
-    seen = set()
-    for entry in logs:
+        # fallback: regex search for http...xxx.pdf
+        m = _ATTACH_URL_RE_B.search(raw)
+        return m.group(1).decode('utf-8', errors='ignore') if m else None
+    # common field names
+    if isinstance(j, dict):
+        for fk in ('urlhref', 'fileUrl', 'downloadUrl', 'url'):
+            v = j.get(fk)
+            if isinstance(v, str) and v.startswith('http'):
+                return v
+    # deep search
+    return _find_url_in_json(j)
+
+def extract_urls_from_perf_logs(driver) -> List[str]:
+    urls = []
+    listener = live_cdp_listener(driver)
+    if listener is not None:
+        # events were pushed over the CDP websocket; no log draining needed
+        events = listener.drain_responses()
+    else:
         try:
-            msg = json.loads(entry.get('message', '{}')).get('message', {})
-            method = msg.get('method', '')
-            if method == 'Network.responseReceived':
+            logs = driver.get_log('performance')
+        except Exception:
+            return urls
+        events = []
+        for entry in logs:
+            raw = entry.get('message', '')
+            # cheap substring test first: most entries are other Network.* events
+            if '"Network.responseReceived"' not in raw:
+                continue
+            try:
+                msg = json.loads(raw).get('message', {})
+            except Exception:
+                continue
+            if msg.get('method', '') == 'Network.responseReceived':
                 params = msg.get('params', {})
-                resp = params.get('response', {})
-                request_id = params.get('requestId')
-                # first try headers / url
-                url = resp.get('url', '')
-                mime = resp.get('mimeType', '') or ''
-                headers = resp.get('headers') or {}
-                cd = (headers.get('Content-Disposition') or headers.get('content-disposition') or '')
-                if url and (looks_like_attachment(url) or 'attachment' in cd.lower() or any(k in mime for k in ['pdf', 'zip', 'rar', 'msword'])):
-                    if url not in seen:
-                        seen.add(url)
-                        urls.append(url)
-                # try to fetch response body and parse JSON for urlhref
-                if request_id:
-                    try:
-                        body = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
-                        text = ""
-                        if isinstance(body, dict):
-                            # body may contain 'body' and 'base64Encoded'
-                            b = body.get('body', '')
-                            if body.get('base64Encoded'):
-                                try:
-                                    text = base64.b64decode(b).decode('utf-8', errors='ignore')
-                                except Exception:
-                                    text = ""
-                            else:
-                                text = b
-                        else:
-                            text = str(body)
-                        if text:
-                            # search for obvious patterns like "urlhref":"http..." or "result":{"urlhref":"..."}
-                            # try JSON parse
-                            try:
-                                j = json.loads(text)
-                                # search nested
-                                def find_url(obj):
-                                    if isinstance(obj, dict):
-                                        for k, v in obj.items():
-                                            if isinstance(v, str) and any(v.endswith(ext) for ext in ATTACH_EXTS):
-                                                return v
-                                            if isinstance(v, str) and v.startswith('http') and ('down.bidcenter' in v or any(ext in v for ext in ATTACH_EXTS)):
-                                                return v
-                                            res = find_url(v)
-                                            if res:
-                                                return res
-                                    elif isinstance(obj, list):
-                                        for it in obj:
-                                            res = find_url(it)
-                                            if res:
-                                                return res
-                                    return None
-                                found = None
-                                # common field names
-                                for fk in ('urlhref', 'fileUrl', 'downloadUrl', 'url'):
-                                    if fk in j:
-                                        v = j.get(fk)
-                                        if isinstance(v, str) and v.startswith('http'):
-                                            found = v
-                                            break
-                                if not found:
-                                    # deep search
-                                    found = find_url(j)
-                                if found and found not in seen:
-                                    seen.add(found)
-                                    urls.append(found)
-                            except Exception:
-                                # fallback: regex search for http...xxx.pdf
-                                m = re.search(r'(https?://[^\s"\'<>]+(?:' + '|'.join([re.escape(e) for e in ATTACH_EXTS]) + r'))', text, re.I)
-                                if m:
-                                    found = m.group(1)
-                                    if found not in seen:
-                                        seen.add(found)
-                                        urls.append(found)
-                    except Exception:
-                        # CDP getResponseBody may fail; ignore
-                        pass
+                if not is_asset_response(params):
+                    events.append(params)
+
+    # skip responses already handled by an earlier poll; each request is inspected once per driver
+    processed = getattr(driver, '_perf_seen', None)
+    if processed is None:
+        processed = driver._perf_seen = set()
+    events = [p for p in events if p.get('requestId') not in processed]
+    processed.update(p.get('requestId') for p in events if p.get('requestId'))
+
+    # fetch all response bodies up front: concurrently over the websocket, or one by one via chromedriver
+    request_ids = [p.get('requestId') for p in events if p.get('requestId')]
+    bodies = {}
+    if listener is not None:
+        try:
+            bodies = dict(zip(request_ids, listener.get_response_bodies(request_ids)))
+        except Exception:
+            bodies = {}
+    else:
+        for rid in request_ids:
+            try:
+                bodies[rid] = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": rid})
+            except Exception:
+                # CDP getResponseBody may fail; ignore
+                pass
+
+    seen = set()
+    for params in events:
+        try:
+            resp = params.get('response', {})
+            # first try headers / url
+            url = resp.get('url', '')
+            mime = resp.get('mimeType', '') or ''
+            headers = resp.get('headers') or {}
+            cd = (headers.get('Content-Disposition') or headers.get('content-disposition') or '')
+            if url and (looks_like_attachment(url) or 'attachment' in cd.lower() or any(k in mime for k in ['pdf', 'zip', 'rar', 'msword'])):
+                if url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+            # then parse the response body for urlhref
+            raw = _response_body_bytes(bodies.get(params.get('requestId')))
+            if raw:
+                found = _find_url_in_body(raw)
+                if found and found not in seen:
+                    seen.add(found)
+                    urls.append(found)
         except Exception:
             continue
     return urls
@@ -289,52 +686,112 @@ def extract_urls_from_perf_logs(driver) -> List[str]:
 # -------------------------
 # Download wrapper: use requests session derived from driver
 # -------------------------
+def _download_skip_reason(headers) -> Optional[str]:
+    # HTML error pages behind attachment-looking URLs, or files over the size cap
+    ctype = (headers.get('Content-Type') or '').lower()
+    cd = (headers.get('Content-Disposition') or '').lower()
+    if ctype.startswith('text/html') and 'attachment' not in cd:
+        return f"Content-Type {ctype}"
+    size = headers.get('Content-Length') or ''
+    if size.isdigit() and int(size) > MAX_DOWNLOAD_BYTES:
+        return f"Content-Length {size} 超过上限"
+    return None
+
 def download_with_session(session: requests.Session, url: str, out_dir: Path, filename_override: Optional[str]=None) -> Optional[Path]:
+    out_path = None
     try:
         ensure_dir(out_dir)
         parsed_name = filename_override or derive_filename_from_url(url)
         out_path = out_dir / parsed_name
         logger.info(f"尝试下载: {url} -> {out_path.name}")
-        with session.get(url, stream=True, timeout=60, allow_redirects=True) as r:
+        # identity: archives/PDFs are already compressed, don't pay for gzip on top
+        with session.get(url, stream=True, timeout=60, allow_redirects=True, headers={'Accept-Encoding': 'identity'}) as r:
             r.raise_for_status()
+            # stream=True returns after the headers: vet them before reading any body
+            reason = _download_skip_reason(r.headers)
+            if reason:
+                logger.info(f"跳过下载: {url} ({reason})")
+                return None
+            written = 0
             with open(out_path, 'wb') as f:
                 for chunk in r.iter_content(chunk_size=8192):
                     if chunk:
+                        written += len(chunk)
+                        if written > MAX_DOWNLOAD_BYTES:
+                            raise IOError(f"超过大小上限 {MAX_DOWNLOAD_BYTES} 字节")
                         f.write(chunk)
         logger.info(f"下载完成: {out_path}")
         return out_path
     except Exception as e:
         logger.warning(f"下载失败: {url} -> {e}")
+        if out_path is not None and out_path.exists():
+            try:
+                out_path.unlink()
+            except Exception:
+                pass
         return None
 
+def free_filename(out_dir: Path, url: str, taken: set) -> str:
+    # 同名加序号，既不与本批已分配的名字冲突，也不覆盖目录中已下载的文件
+    name = derive_filename_from_url(url) or 'download'
+    stem, ext = os.path.splitext(name)
+    n = 0
+    while name in taken or (out_dir / name).exists():
+        n += 1
+        name = f"{stem}_{n}{ext}"
+    taken.add(name)
+    return name
+
+def download_all(session: requests.Session, urls: List[str], out_dir: Path) -> List[Path]:
+    # 先分配文件名（同名加序号），避免并发写同一路径
+    taken = set()
+    jobs = [(url, free_filename(out_dir, url, taken)) for url in dict.fromkeys(urls)]
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(jobs))) as pool:
+        paths = list(pool.map(lambda job: download_with_session(session, job[0], out_dir, job[1]), jobs))
+    return [p for p in paths if p]
+
 # -------------------------
 # 解压与上传
 # -------------------------
-def extract_and_upload_file(path: Path, task_id: str, page_title_15: str, uploaded: List[str], messages: List[str]):
-    # If zip or rar, extract then upload inner files individually with naming rule
+# (upload name, opener returning a fresh binary file object)
+UploadItem = Tuple[str, Callable[[], BinaryIO]]
+
+def _archive_member_items(archive, path: Path, task_id: str, page_title_15: str) -> List[UploadItem]:
+    # members are streamed straight into the upload; nothing is extracted to disk
+    items = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        fi = info.filename.replace('\\', '/').rsplit('/', 1)[-1]
+        items.append((f"{task_id}{page_title_15}附件{path.name}_{fi}", functools.partial(archive.open, info)))
+    return items
+
+def collect_upload_items(path: Path, task_id: str, page_title_15: str, stack: ExitStack, messages: List[str]) -> List[UploadItem]:
+    # If zip or rar, inner files are uploaded individually with naming rule; archives stay open on `stack`
     if path.suffix.lower() == '.zip':
         try:
-            extract_dir = path.parent / f"_extracted_{path.stem}"
-            ensure_dir(extract_dir)
-            with zipfile.ZipFile(str(path), 'r') as zf:
-                zf.extractall(str(extract_dir))
+            zf = stack.enter_context(zipfile.ZipFile(str(path), 'r'))
             messages.append(f"  解压 zip 成功: {path.name}")
-            for root, _, files in os.walk(str(extract_dir)):
-                for fi in files:
-                    src = Path(root) / fi
-                    stdname = f"{task_id}{page_title_15}附件{path.name}_{fi}"
-                    dest = path.parent / stdname
-                    shutil.copy2(src, dest)
-                    ok, info = upload_file_to_bisheng(dest)
-                    messages.append(f"    上传解压文件 '{dest.name}' => {ok} ({info})")
-                    if ok:
-                        uploaded.append(dest.name)
+            return _archive_member_items(zf, path, task_id, page_title_15)
         except Exception as e:
             messages.append(f"  zip 解压失败: {e}")
+            return []
     elif path.suffix.lower() == '.rar':
+        if rarfile is not None:
+            try:
+                rf = stack.enter_context(rarfile.RarFile(str(path)))
+                messages.append(f"  rar 解压成功: {path.name}")
+                return _archive_member_items(rf, path, task_id, page_title_15)
+            except Exception as e:
+                messages.append(f"  rar 解压失败: {e}")
+                return []
         if patoolib is None:
-            messages.append("  patoolib 未安装，无法解压 rar")
-            return
+            messages.append("  rarfile/patoolib 均未安装，无法解压 rar")
+            return []
+        # patoolib shells out and can only extract to disk
+        items = []
         try:
             extract_dir = path.parent / f"_extracted_{path.stem}"
             ensure_dir(extract_dir)
@@ -345,52 +802,150 @@ def extract_and_upload_file(path: Path, task_id: str, page_title_15: str, upload
                     src = Path(root) / fi
                     stdname = f"{task_id}{page_title_15}附件{path.name}_{fi}"
                     dest = path.parent / stdname
-                    shutil.copy2(src, dest)
-                    ok, info = upload_file_to_bisheng(dest)
-                    messages.append(f"    上传解压文件 '{dest.name}' => {ok} ({info})")
-                    if ok:
-                        uploaded.append(dest.name)
+                    # extracted file is single-use: rename, don't copy
+                    os.replace(src, dest)
+                    items.append((dest.name, functools.partial(open, dest, 'rb')))
         except Exception as e:
             messages.append(f"  rar 解压失败: {e}")
+        return items
     else:
         # normal file
         stdname = f"{task_id}{page_title_15}附件{path.name}"
         dest = path.parent / stdname
         try:
-            if not dest.exists():
-                shutil.copy2(path, dest)
-            ok, info = upload_file_to_bisheng(dest)
-            messages.append(f"  上传文件 '{dest.name}' => {ok} ({info})")
-            if ok:
-                uploaded.append(dest.name)
+            # same directory: an inode rename, no bytes copied
+            os.replace(path, dest)
         except Exception as e:
             messages.append(f"  上传失败: {dest.name} -> {e}")
+            return []
+        return [(dest.name, functools.partial(open, dest, 'rb'))]
 
 # -------------------------
-# 上传单文件到毕昇
+# 上传到毕昇
 # -------------------------
-def upload_file_to_bisheng(file_path: Path) -> Tuple[bool, str]:
+# shared keep-alive session: one TCP/TLS handshake for all uploads, safe across upload threads
+UPLOAD_SESSION = requests.Session()
+UPLOAD_SESSION.verify = REQUESTS_VERIFY
+
+def _bisheng_upload_endpoint() -> str:
+    return f"{BISHENG_API_BASE_URL.rstrip('/')}/api/v2/filelib/file/{KNOWLEDGE_BASE_ID}"
+
+def upload_stream_to_bisheng(name: str, fileobj) -> Tuple[bool, str]:
     try:
-        endpoint = f"{BISHENG_API_BASE_URL.rstrip('/')}/api/v2/filelib/file/{KNOWLEDGE_BASE_ID}"
-        with open(file_path, 'rb') as fh:
-            files = {'file': (file_path.name, fh, 'application/octet-stream')}
-            r = requests.post(endpoint, files=files, timeout=120, verify=REQUESTS_VERIFY)
-            r.raise_for_status()
-            return True, f"HTTP{r.status_code}"
+        files = {'file': (name, fileobj, 'application/octet-stream')}
+        r = UPLOAD_SESSION.post(_bisheng_upload_endpoint(), files=files, timeout=120)
+        r.raise_for_status()
+        return True, f"HTTP{r.status_code}"
+    except Exception as e:
+        return False, f"UploadFailed: {e}"
+
+def _upload_item(item: UploadItem) -> Tuple[bool, str]:
+    name, opener = item
+    try:
+        with opener() as fh:
+            return upload_stream_to_bisheng(name, fh)
     except Exception as e:
         return False, f"UploadFailed: {e}"
 
+def upload_files_to_bisheng(items: List[UploadItem]) -> Tuple[Optional[int], str]:
+    # one multipart request carrying every file; returns (HTTP status or None, info)
+    try:
+        with ExitStack() as stack:
+            files = [('file', (name, stack.enter_context(opener()), 'application/octet-stream')) for name, opener in items]
+            r = UPLOAD_SESSION.post(_bisheng_upload_endpoint(), files=files, timeout=120 + 10 * len(items))
+        return r.status_code, f"HTTP{r.status_code}"
+    except Exception as e:
+        return None, f"UploadFailed: {e}"
+
+def upload_items_to_bisheng(items: List[UploadItem], uploaded: List[str], messages: List[str]):
+    results: List[Optional[Tuple[bool, str]]] = [None] * len(items)
+    pending = list(range(len(items)))
+    if BISHENG_BATCH_UPLOAD and len(items) > 1:
+        pending = []
+        for start in range(0, len(items), BISHENG_BATCH_MAX_FILES):
+            batch = list(range(start, min(start + BISHENG_BATCH_MAX_FILES, len(items))))
+            status, info = upload_files_to_bisheng([items[i] for i in batch])
+            if status is not None and 200 <= status < 300:
+                for i in batch:
+                    results[i] = (True, f"{info}, 批量 {len(batch)} 件")
+            elif status in BISHENG_BATCH_REJECT_STATUS:
+                messages.append(f"  批量上传被拒绝 ({info})，回退逐个上传")
+                pending.extend(batch)
+            else:
+                for i in batch:
+                    results[i] = (False, info)
+    # per-file uploads, concurrently over the shared session
+    if pending:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            for i, res in zip(pending, pool.map(_upload_item, [items[i] for i in pending])):
+                results[i] = res
+    for (name, _), (ok, info) in zip(items, results):
+        messages.append(f"  上传文件 '{name}' => {ok} ({info})")
+        if ok:
+            uploaded.append(name)
+
 # -------------------------
 # Strategy A (robust): handle opendown -> iframe -> GetValidateCode links
 # -------------------------
-def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, work_dir: Path, messages: List[str]) -> List[Path]:
+# CSS attribute selectors are matched natively by Blink; '*=' keeps the old XPath contains() semantics
+IFRAME_CANDIDATE_SELECTOR = ','.join(['a[onclick*="GetValidateCode"]'] + [
+    f'a[{attr}*="{ext}"]' for attr in ('href', 'title') for ext in ('.pdf', '.doc', '.zip', '.rar')])
+
+# strategy A needs an opendown() trigger or an iframe already on the page; checked in-browser, nothing transferred
+STRATEGY_A_PROBE_JS = "return document.documentElement.innerHTML.indexOf('opendown') >= 0 || document.getElementsByTagName('iframe').length > 0;"
+
+# resolved href of an anchor; SVG <a> exposes an SVGAnimatedString instead of a string
+ANCHOR_HREF_JS = """
+function anchorHref(a) {
+    var h = a.href;
+    if (typeof h === 'string') return h;
+    h = h && h.baseVal;
+    try { return h ? new URL(h, document.baseURI).href : ''; } catch (e) { return ''; }
+}
+"""
+
+# one round trip per iframe: element refs (for clicking) plus every field the loop needs
+IFRAME_CANDIDATES_JS = ANCHOR_HREF_JS + """
+var out = [];
+document.querySelectorAll(arguments[0]).forEach(function (a) {
+    var onclick = a.getAttribute('onclick') || '';
+    var m = onclick.match(/GetValidateCode\\(['"]?([^'")]+)['"]?\\)/);
+    out.push({el: a, href: anchorHref(a), onclick: onclick,
+              title: (a.title || a.innerText || '').trim().slice(0, 120), selid: m ? m[1] : null});
+});
+return out;
+"""
+
+def strategy_iframe_popups(driver, task_id: str, page_title_15: str, work_dir: Path,
+                           messages: List[str]) -> Tuple[List[str], List[Path]]:
+    # returns (direct links, left to download_all, files already downloaded). Links revealed by clicking
+    # GetValidateCode are downloaded on the spot and the first success ends that candidate, so the later
+    # lookups neither fetch the same file under another URL nor wait on traffic the listener never sees.
     messages.append("  [策略A] 尝试触发 opendown() 并解析 iframe 内附件...")
+    found = []
     downloaded = []
+    fetched = {}  # url -> downloaded path (or None)
+
+    def fetch(u: str) -> bool:
+        if u not in fetched:
+            # session built now so it carries the cookies the click just set
+            fetched[u] = download_with_session(session_from_driver(driver), u, work_dir,
+                                               free_filename(work_dir, u, set()))
+            if fetched[u]:
+                downloaded.append(fetched[u])
+        return fetched[u] is not None
+
+    try:
+        if not driver.execute_script(STRATEGY_A_PROBE_JS):
+            messages.append("    页面无 opendown 触发点且无 iframe，跳过策略A")
+            return found, downloaded
+    except Exception:
+        pass
     try:
         # 1) find and click opendown triggers (anchors/buttons)
         triggers = []
         try:
-            triggers = driver.find_elements(By.XPATH, "//*[contains(@onclick,'opendown')] | //a[contains(@onclick,'opendown')] | //button[contains(@onclick,'opendown')]")
+            triggers = driver.find_elements(By.CSS_SELECTOR, '[onclick*="opendown"]')
         except Exception:
             triggers = []
         if triggers:
@@ -413,6 +968,7 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
             try:
                 # check iframe src to prefer attachment iframes
                 src = ifr.get_attribute('src') or ''
+                note_origin(driver, src)
                 if not src:
                     # still try to switch
                     pass
@@ -424,26 +980,21 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                     continue
                 messages.append(f"    切入 iframe#{idx} (src={src})")
                 # find candidate links inside iframe
-                cand = driver.find_elements(By.XPATH, ".//a[contains(@onclick,'GetValidateCode')] | .//a[contains(@href,'.pdf') or contains(@href,'.doc') or contains(@href,'.zip') or contains(@href,'.rar')] | .//a[contains(@title,'.pdf') or contains(@title,'.doc') or contains(@title,'.zip') or contains(@title,'.rar')]")
+                cand = driver.execute_script(IFRAME_CANDIDATES_JS, IFRAME_CANDIDATE_SELECTOR) or []
                 messages.append(f"      在 iframe#{idx} 发现候选链接: {len(cand)}")
                 base_handles = set(driver.window_handles)
-                for i, el in enumerate(cand):
+                for i, c in enumerate(cand):
                     try:
-                        title = (el.get_attribute('title') or el.text or '').strip()[:120]
-                        messages.append(f"      处理候选 {i+1}: '{title}'")
-                        href = el.get_attribute('href') or ''
-                        onclick = el.get_attribute('onclick') or ''
+                        el = c['el']
+                        messages.append(f"      处理候选 {i+1}: '{c['title']}'")
+                        href = c['href']
                         # Case 1: direct href to file
                         if href and href.strip().lower().startswith('http') and looks_like_attachment(href):
-                            path = download_with_session(session, href, work_dir)
-                            if path:
-                                downloaded.append(path)
+                            if href not in found:
+                                found.append(href)
                             continue
-                        # Case 2: onclick contains GetValidateCode('selid')
-                        m = re.search(r"GetValidateCode\(['\"]?([^'\")]+)['\"]?\)", onclick)
-                        selid = None
-                        if m:
-                            selid = m.group(1)
+                        # Case 2: onclick contains GetValidateCode('selid') (parsed in JS)
+                        selid = c['selid']
                         # click the link to trigger validation
                         try:
                             driver.execute_script("arguments[0].scrollIntoView({block:'center'})", el)
@@ -459,8 +1010,8 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                                 pass
                         except Exception as e:
                             messages.append(f"        点击失败: {e}")
-                        # after click: three attempts to discover download URL
-                        got_one = False
+                        # after click: three attempts to discover download URL; stop at the first that downloads
+                        new_url = None
                         # A. wait for new window
                         try:
                             t0 = time.time()
@@ -472,12 +1023,8 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                                     driver.switch_to.window(new_win)
                                     time.sleep(0.6)
                                     new_url = driver.current_url
+                                    note_origin(driver, new_url)
                                     messages.append(f"        新窗口出现: {new_url}")
-                                    if new_url and new_url.startswith('http') and looks_like_attachment(new_url):
-                                        p = download_with_session(session, new_url, work_dir)
-                                        if p:
-                                            downloaded.append(p)
-                                            got_one = True
                                     # close new window and go back
                                     try:
                                         driver.close()
@@ -491,11 +1038,12 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                                 time.sleep(0.3)
                         except Exception as e:
                             messages.append(f"        检查新窗口异常: {e}")
-                        if got_one:
+                        if new_url and new_url.startswith('http') and looks_like_attachment(new_url) and fetch(new_url):
                             continue
                         # B. poll performance logs + CDP getResponseBody (search json.result.urlhref)
                         perf_found = None
-                        for _ in range(PERF_POLL_ITER):
+                        deadline = time.time() + PERF_POLL_ITER * PERF_POLL_SLEEP
+                        while True:
                             perf_urls = extract_urls_from_perf_logs(driver)
                             if perf_urls:
                                 # prefer ones that look like attachments or contain down.bidcenter
@@ -507,15 +1055,19 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                                         break
                             if perf_found:
                                 break
-                            time.sleep(PERF_POLL_SLEEP)
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                break
+                            listener = live_cdp_listener(driver)
+                            if listener is not None:
+                                # event-driven: return the moment Network.loadingFinished arrives
+                                listener.wait_for_responses(remaining)
+                            else:
+                                time.sleep(min(PERF_POLL_SLEEP, remaining))
                         if perf_found:
                             messages.append(f"        从 performance logs 找到: {perf_found}")
-                            p = download_with_session(session, perf_found, work_dir)
-                            if p:
-                                downloaded.append(p)
-                                got_one = True
-                        if got_one:
-                            continue
+                            if fetch(perf_found):
+                                continue
                         # C. inspect DOM container (selid)
                         if selid:
                             try:
@@ -524,16 +1076,14 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                                     elc = driver.find_element(By.ID, selid)
                                     inner_html = elc.get_attribute('innerHTML') or ''
                                     # find any http link inside
-                                    m2 = re.search(r'href=[\'"]([^\'"]+)[\'"]', inner_html, re.I)
+                                    m2 = _HREF_RE.search(inner_html)
                                     if m2:
-                                        candidate = m2.group(1)
+                                        # raw innerHTML keeps entities such as &amp; in the query string
+                                        candidate = unescape(m2.group(1))
                                         if not candidate.startswith('http'):
                                             candidate = urljoin(driver.current_url, candidate)
                                         messages.append(f"        在容器 {selid} 中发现链接: {candidate}")
-                                        p = download_with_session(session, candidate, work_dir)
-                                        if p:
-                                            downloaded.append(p)
-                                            got_one = True
+                                        fetch(candidate)
                                 except Exception:
                                     pass
                             except Exception:
@@ -556,50 +1106,45 @@ def strategy_iframe_popups(driver, session, task_id: str, page_title_15: str, wo
                     pass
     except Exception as e:
         messages.append(f"  [策略A] 异常: {e}")
-    messages.append(f"  [策略A] 共下载 {len(downloaded)} 个文件")
-    return downloaded
+    # a direct link already fetched after a click must not be downloaded again
+    found = [u for u in found if u not in fetched]
+    messages.append(f"  [策略A] 共发现 {len(found)} 个直链，已下载 {len(downloaded)} 个文件")
+    return found, downloaded
 
 # -------------------------
 # Strategy B (page straight links) - main page + detial 标签
 # -------------------------
-def strategy_direct_links(driver, session, task_id: str, page_title_15: str, work_dir: Path, messages: List[str]) -> List[Path]:
-    downloaded = []
+ANCHOR_HREFS_JS = ANCHOR_HREF_JS + "return Array.from(document.querySelectorAll('a')).map(anchorHref);"
+
+# markup of non-anchor link-bearing elements only; <a> hrefs are already fetched by the anchor scan
+LINK_MARKUP_JS = "return Array.from(document.querySelectorAll('area[href],link[href],iframe[src],embed[src],object[data]')).map(e => e.outerHTML).join('');"
+
+def strategy_direct_links(driver, task_id: str, page_title_15: str, messages: List[str]) -> List[str]:
+    cand = []
     messages.append("  [策略B] 页面直链与 detial 区域扫描（兜底）")
     try:
         driver.switch_to.default_content()
-        # First, all <a> tags
-        anchors = driver.find_elements(By.TAG_NAME, 'a')
-        cand = []
-        for a in anchors:
-            try:
-                href = a.get_attribute('href') or ''
-                txt = (a.text or a.get_attribute('title') or '').strip()
-            except Exception:
-                continue
+        # First, all <a> tags (resolved hrefs in one round trip)
+        hrefs = driver.execute_script(ANCHOR_HREFS_JS) or []
+        for href in hrefs:
             if href and not href.strip().lower().startswith('javascript') and looks_like_attachment(href):
                 cand.append(href)
-        # Second, scan page source for href="..." patterns (some links rendered in HTML)
-        try:
-            html = driver.page_source or ''
-            for m in re.findall(r'href=[\'"]([^\'"]+)[\'"]', html, re.I):
-                if looks_like_attachment(m):
-                    full = urljoin(driver.current_url, m)
-                    if full not in cand:
-                        cand.append(full)
-        except Exception:
-            pass
-        messages.append(f"    直链候选数: {len(cand)}")
-        for u in cand:
+        # Second, only if anchors gave nothing: links rendered outside <a> (no full page_source transfer)
+        if not cand:
             try:
-                path = download_with_session(session, u, work_dir)
-                if path:
-                    downloaded.append(path)
-            except Exception as e:
-                messages.append(f"    下载直链失败: {u} -> {e}")
+                html = driver.execute_script(LINK_MARKUP_JS) or ''
+                base = driver.current_url
+                for m in extract_hrefs_from_html(html):
+                    if looks_like_attachment(m):
+                        full = urljoin(base, m)
+                        if full not in cand:
+                            cand.append(full)
+            except Exception:
+                pass
+        messages.append(f"    直链候选数: {len(cand)}")
     except Exception as e:
         messages.append(f"  [策略B] 异常: {e}")
-    messages.append(f"  [策略B] 共下载 {len(downloaded)} 个文件")
-    return downloaded
+    return cand
 
 # -------------------------
 # Main single-task processor
@@ -613,13 +1158,16 @@ def handle_single_task(task_id: str, url: str) -> dict:
     ensure_dir(work_dir)
 
     driver = None
+    reusable = True
     try:
-        # create driver & session
+        # take a browser from the pool & create session
         messages.append(f"  为本次任务创建临时下载目录: {work_dir}")
-        driver = build_driver(download_dir=work_dir, headless=HEADLESS)
-        messages.append("  浏览器启动成功")
+        driver = acquire_driver(work_dir)
+        messages.append("  浏览器就绪")
+        note_origin(driver, url)
         driver.get(url)
         time.sleep(1.0)
+        note_origin(driver, driver.current_url)
         # get page title (h3优先)
         try:
             h3s = driver.find_elements(By.TAG_NAME, 'h3')
@@ -636,18 +1184,20 @@ def handle_single_task(task_id: str, url: str) -> dict:
         page_title_15 = short_title(page_title)
         messages.append(f"  页面标题(前15): {page_title_15}")
 
-        session = session_from_driver(driver)
-
-        # Strategy A
+        # Strategy A: collect links, then download them concurrently
         messages.append("  开始执行 策略A (iframe 弹窗内 GetValidateCode / 直链)")
-        downloaded_a = strategy_iframe_popups(driver, session, task_id, page_title_15, work_dir, messages)
+        urls_a, downloaded_a = strategy_iframe_popups(driver, task_id, page_title_15, work_dir, messages)
+        # session built after the clicks so it carries any cookies they set
+        session = session_from_driver(driver)
+        downloaded_a += download_all(session, urls_a, work_dir)
         messages.append(f"  策略A 获取文件数: {len(downloaded_a)}")
 
         # Strategy B if no files
         downloaded_b = []
         if not downloaded_a:
             messages.append("  策略A 未获取到文件，开始执行 策略B (主页面直链)")
-            downloaded_b = strategy_direct_links(driver, session, task_id, page_title_15, work_dir, messages)
+            urls_b = strategy_direct_links(driver, task_id, page_title_15, messages)
+            downloaded_b = download_all(session, urls_b, work_dir)
             messages.append(f"  策略B 获取文件数: {len(downloaded_b)}")
         else:
             messages.append("  策略A 已获取文件，跳过 策略B")
@@ -657,13 +1207,16 @@ def handle_single_task(task_id: str, url: str) -> dict:
             messages.append(f"任务ID {task_id}: 未找到任何附件。")
             return {'status': 'no_content', 'message': f"任务ID {task_id}: 未找到任何附件。", 'messages': messages}
 
-        # 处理下载并上传
+        # 处理下载并上传: collect every (renamed / archive member) file first, then upload in one pass
         uploaded = []
-        for f in downloaded:
-            if not f or not Path(f).exists():
-                messages.append(f"  文件缺失: {f}")
-                continue
-            extract_and_upload_file(Path(f), task_id, page_title_15, uploaded, messages)
+        with ExitStack() as stack:
+            items: List[UploadItem] = []
+            for f in downloaded:
+                if not f or not Path(f).exists():
+                    messages.append(f"  文件缺失: {f}")
+                    continue
+                items.extend(collect_upload_items(Path(f), task_id, page_title_15, stack, messages))
+            upload_items_to_bisheng(items, uploaded, messages)
 
         messages.append(f"--- [附件攻坚任务] ID {task_id} 结束: 上传 {len(uploaded)} 件 ---")
         return {'status': 'success', 'report': f"上传 {len(uploaded)} 件", 'uploaded': uploaded, 'messages': messages}
@@ -672,18 +1225,11 @@ def handle_single_task(task_id: str, url: str) -> dict:
         tb = traceback.format_exc()
         logger.error(f"!!! 任务ID {task_id} 崩溃: {e}\n{tb}")
         messages.append(f"!!! 任务失败: {e}")
-        try:
-            if driver:
-                driver.quit()
-        except Exception:
-            pass
+        reusable = False
         return {'status': 'error', 'message': str(e), 'messages': messages}
     finally:
-        try:
-            if driver:
-                driver.quit()
-        except Exception:
-            pass
+        if driver:
+            release_driver(driver, reusable)
 
 # -------------------------
 # Flask routes
@@ -762,4 +1308,5 @@ def upload_to_bisheng():
 # -------------------------
 if __name__ == '__main__':
     ensure_dir(TEMP_DOWNLOAD_DIR)
+    warm_driver_pool()
     app.run(host=SERVER_BIND_IP, port=SERVER_PORT)
